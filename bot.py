@@ -1,42 +1,138 @@
+import asyncio
+import atexit
 import logging
 import os
+import re
+import secrets
 import sqlite3
 import threading
+import time
+from collections import OrderedDict
+from collections.abc import AsyncIterator
+from contextlib import AsyncExitStack, asynccontextmanager, suppress
+from functools import partial
 from pathlib import Path
 from typing import Any
 
-import requests
+import httpx
+import orjson
 import uvicorn
 from dotenv import load_dotenv
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import ORJSONResponse
 from telegram import Update
 from telegram.ext import Application, CommandHandler, ContextTypes
+from telegram.request import HTTPXRequest
 
+try:
+    import uvloop
+except ImportError:  # uvloop is not available on Windows
+    uvloop = None
+
+
+BASE_DIR = Path(__file__).parent
+load_dotenv(BASE_DIR / ".env")
 
-BASE_DIR = Path(__file__).resolve().parent
 STRELKA_STATUS_URL = "https://strelkacard.ru/api/cards/status/"
 DEFAULT_CARD_TYPE_ID = "3ae427a1-0f17-4524-acb1-a3f50090a8f3"
+CARD_TYPE_ID = os.getenv("STRELKA_CARD_TYPE_ID", DEFAULT_CARD_TYPE_ID)
+WEBHOOK_PATH = "/tg/webhook"
+WEBHOOK_SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+STATUS_HEADERS = {"Cache-Control": "public, max-age=5, stale-while-revalidate=60"}
+ROOT_BODY = orjson.dumps({"status": "ok", "service": "strelka-bot-web-stub"})
+HEALTH_BODY = orjson.dumps({"status": "healthy"})
+CARD_NUMBER_RE = re.compile(r"[0-9]+")
+STATUS_FIELDS = ("balance", "cardactive", "cardblocked", "numoftrips")
+STATUS_TEMPLATE = (
+    "Информация по карте:\n"
+    "Баланс: %.2f руб. (%d коп.)\n"
+    "Карта активна: %s\n"
+    "Карта заблокирована: %s\n"
+    "Поездок: %s"
+)
+STATUS_CACHE_MAX_AGE = 30
+STATUS_CACHE_STALE_WHILE_REVALIDATE = 600
+STATUS_CACHE_SIZE = 10_000
 
 logging.basicConfig(
     format="%(asctime)s | %(levelname)s | %(name)s | %(message)s", level=logging.INFO
 )
 logger = logging.getLogger(__name__)
 
-app_web = FastAPI(title="strelka-bot-web-stub")
+# The URL and the constant cardtypeid are baked into the client once, so each
+# /balance request only adds the card number.
+http_client = httpx.AsyncClient(
+    base_url=STRELKA_STATUS_URL,
+    params={"cardtypeid": CARD_TYPE_ID},
+    timeout=20,
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=10),
+)
+
+_status_cache: dict[str, tuple[float, str]] = {}
+_status_inflight: dict[str, asyncio.Task[str]] = {}
+
+
+class StrelkaApiError(Exception):
+    pass
 
 
 class Storage:
+    # sqlite3 reuses prepared statements keyed by SQL text, so keep it constant.
+    _UPSERT_CARD_SQL = """
+        INSERT INTO user_cards (user_id, card_number)
+        VALUES (?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            card_number=excluded.card_number,
+            updated_at=CURRENT_TIMESTAMP
+    """
+    _SELECT_CARD_SQL = "SELECT card_number FROM user_cards WHERE user_id = ?"
+    # Writes arriving within this window are committed in a single transaction.
+    _WRITE_BATCH_INTERVAL = 0.02
+    _OPTIMIZE_INTERVAL = 900
+    _CARD_CACHE_SIZE = 10_000
+
     def __init__(self, db_path: Path) -> None:
         self.db_path = db_path
         self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(
+            self.db_path,
+            timeout=30,
+            check_same_thread=False,
+            isolation_level=None,
+            cached_statements=512,
+        )
+        self._write_lock = threading.Lock()
+        self._writes: asyncio.Queue[tuple[int, str, asyncio.Future[None]] | None] = (
+            asyncio.Queue()
+        )
+        self._writer_task: asyncio.Task[None] | None = None
+        self._optimizer_task: asyncio.Task[None] | None = None
+        # Write-through LRU of user_id -> card_number, only touched from the event loop.
+        self._card_cache: OrderedDict[int, str] = OrderedDict()
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=30000")
+        self._conn.execute("PRAGMA temp_store=MEMORY")
+        self._conn.execute("PRAGMA cache_size=-64000")
         self._init_db()
-
-    def _connect(self) -> sqlite3.Connection:
-        return sqlite3.connect(self.db_path)
+        # A connection always sees its own uncommitted rows, so reads go through a
+        # separate read-only connection that only observes committed data.
+        self._reader = sqlite3.connect(
+            f"{self.db_path.resolve().as_uri()}?mode=ro",
+            uri=True,
+            timeout=30,
+            check_same_thread=False,
+            isolation_level=None,
+            cached_statements=512,
+        )
+        self._reader.execute("PRAGMA busy_timeout=30000")
+        self._reader.execute("PRAGMA temp_store=MEMORY")
+        self._reader.execute("PRAGMA cache_size=-64000")
+        atexit.register(self.close)
 
     def _init_db(self) -> None:
-        with self._connect() as conn:
-            conn.execute(
+        with self._write_lock:
+            self._conn.execute(
                 """
                 CREATE TABLE IF NOT EXISTS user_cards (
                     user_id INTEGER PRIMARY KEY,
@@ -46,43 +142,200 @@ class Storage:
                 )
                 """
             )
-            conn.commit()
-
-    def set_user_card(self, user_id: int, card_number: str) -> None:
-        with self._connect() as conn:
-            conn.execute(
-                """
-                INSERT INTO user_cards (user_id, card_number)
-                VALUES (?, ?)
-                ON CONFLICT(user_id) DO UPDATE SET
-                    card_number=excluded.card_number,
-                    updated_at=CURRENT_TIMESTAMP
-                """,
-                (user_id, card_number),
-            )
-            conn.commit()
-
-    def get_user_card(self, user_id: int) -> str | None:
-        with self._connect() as conn:
-            row = conn.execute(
-                "SELECT card_number FROM user_cards WHERE user_id = ?", (user_id,)
-            ).fetchone()
+            # journal_mode is persistent in the database file, so set it once here.
+            self._conn.execute("PRAGMA journal_mode=WAL")
+
+    def start(self) -> None:
+        self._writer_task = asyncio.create_task(self._writer_loop())
+        self._optimizer_task = asyncio.create_task(self._optimizer_loop())
+
+    async def stop(self) -> None:
+        if self._optimizer_task is not None:
+            self._optimizer_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._optimizer_task
+            self._optimizer_task = None
+        if self._writer_task is None:
+            return
+        await self._writes.put(None)
+        await self._writer_task
+        self._writer_task = None
+
+    def close(self) -> None:
+        atexit.unregister(self.close)
+        with self._write_lock:
+            self._conn.execute("PRAGMA optimize")
+            self._conn.close()
+        self._reader.close()
+
+    def optimize(self) -> None:
+        with self._write_lock:
+            self._conn.execute("PRAGMA optimize")
+
+    async def _optimizer_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self._OPTIMIZE_INTERVAL)
+            try:
+                await asyncio.to_thread(self.optimize)
+            except sqlite3.Error:
+                logger.exception("PRAGMA optimize failed")
+
+    async def set_user_card(self, user_id: int, card_number: str) -> None:
+        future: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        await self._writes.put((user_id, card_number, future))
+        await future
+
+    async def _writer_loop(self) -> None:
+        running = True
+        while running:
+            batch = [await self._writes.get()]
+            await asyncio.sleep(self._WRITE_BATCH_INTERVAL)
+            while not self._writes.empty():
+                batch.append(self._writes.get_nowait())
+            running = None not in batch
+            pending = [item for item in batch if item is not None]
+            if pending:
+                await self._flush_writes(pending)
+
+    async def _flush_writes(
+        self, batch: list[tuple[int, str, asyncio.Future[None]]]
+    ) -> None:
+        rows = [(user_id, card_number) for user_id, card_number, _ in batch]
+        try:
+            await asyncio.to_thread(self._write_cards, rows)
+        except Exception as exc:
+            logger.exception("Failed to save %d card(s)", len(rows))
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+        for user_id, card_number in rows:
+            self._cache_card(user_id, card_number)
+        for _, _, future in batch:
+            if not future.done():
+                future.set_result(None)
+
+    def _write_cards(self, rows: list[tuple[int, str]]) -> None:
+        with self._write_lock:
+            # Take the write lock up front so the batch cannot hit SQLITE_BUSY midway.
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(self._UPSERT_CARD_SQL, rows)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                if self._conn.in_transaction:
+                    self._conn.execute("ROLLBACK")
+                raise
+
+    async def get_user_card(self, user_id: int) -> str | None:
+        card_number = self._card_cache.get(user_id)
+        if card_number is not None:
+            self._card_cache.move_to_end(user_id)
+            return card_number
+        card_number = await asyncio.to_thread(self._load_user_card, user_id)
+        # A write committed while we were reading already cached the newer value.
+        if card_number is not None and user_id not in self._card_cache:
+            self._cache_card(user_id, card_number)
+        return card_number
+
+    def _load_user_card(self, user_id: int) -> str | None:
+        row = self._reader.execute(self._SELECT_CARD_SQL, (user_id,)).fetchone()
         if not row:
             return None
         return row[0]
 
+    def _cache_card(self, user_id: int, card_number: str) -> None:
+        self._card_cache[user_id] = card_number
+        self._card_cache.move_to_end(user_id)
+        if len(self._card_cache) > self._CARD_CACHE_SIZE:
+            self._card_cache.popitem(last=False)
+
 
 storage: Storage | None = None
+application: Application | None = None
+webhook_url: str | None = None
+webhook_secret: str | None = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    # The bot runs inside uvicorn's event loop instead of a loop of its own.
+    if storage is None or application is None or webhook_url is None:
+        raise RuntimeError("Бот не инициализирован")
+    # Each step registers its cleanup, so a failure at boot still tears down
+    # whatever had already started.
+    async with AsyncExitStack() as stack:
+        stack.push_async_callback(http_client.aclose)
+        storage.start()
+        stack.push_async_callback(storage.stop)
+        await application.initialize()
+        stack.push_async_callback(application.shutdown)
+        await application.start()
+        stack.push_async_callback(application.stop)
+        await application.bot.set_webhook(
+            url=webhook_url, allowed_updates=Update.ALL_TYPES, secret_token=webhook_secret
+        )
+        yield
+
+
+app_web = FastAPI(
+    title="strelka-bot-web-stub",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 
 @app_web.get("/")
-def root() -> dict[str, str]:
-    return {"status": "ok", "service": "strelka-bot-web-stub"}
+async def root() -> Response:
+    return Response(ROOT_BODY, media_type="application/json", headers=STATUS_HEADERS)
 
 
 @app_web.get("/health")
-def health() -> dict[str, str]:
-    return {"status": "healthy"}
+async def health() -> Response:
+    return Response(HEALTH_BODY, media_type="application/json", headers=STATUS_HEADERS)
+
+
+@app_web.post(WEBHOOK_PATH)
+async def telegram_webhook(request: Request) -> Response:
+    if application is None or webhook_secret is None:
+        return Response(status_code=503)
+    # Starlette decodes headers as latin-1; compare bytes so non-ASCII values get a 403.
+    if not secrets.compare_digest(
+        request.headers.get(WEBHOOK_SECRET_HEADER, "").encode("latin-1"),
+        webhook_secret.encode(),
+    ):
+        return Response(status_code=403)
+
+    try:
+        data = orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        return Response(status_code=400)
+    if not isinstance(data, dict):
+        return Response(status_code=400)
+
+    update = Update.de_json(data, application.bot)
+    await application.update_queue.put(update)
+    return Response()
+
+
+def _fast_parse(card: dict[str, Any]) -> str | None:
+    # Happy path for the usual payload; None means the generic parser must handle it.
+    try:
+        balance_raw = card["balance"]
+        card_active = card["cardactive"]
+        card_blocked = card["cardblocked"]
+        trips = card["numoftrips"]
+        if card_active is None or card_blocked is None or trips is None:
+            return None
+        return STATUS_TEMPLATE % (
+            balance_raw / 100,
+            balance_raw,
+            "да" if card_active else "нет",
+            "да" if card_blocked else "нет",
+            trips,
+        )
+    except (KeyError, TypeError):
+        return None
 
 
 def parse_status_response(data: Any) -> str:
@@ -90,10 +343,11 @@ def parse_status_response(data: Any) -> str:
         raise ValueError("Непредвиденный формат ответа API")
 
     card = data.get("card") if isinstance(data.get("card"), dict) else data
-    balance_raw = card.get("balance")
-    card_active = card.get("cardactive")
-    card_blocked = card.get("cardblocked")
-    trips = card.get("numoftrips")
+    status_text = _fast_parse(card)
+    if status_text is not None:
+        return status_text
+
+    balance_raw, card_active, card_blocked, trips = map(card.get, STATUS_FIELDS)
 
     lines = ["Информация по карте:"]
     if isinstance(balance_raw, (int, float)):
@@ -114,22 +368,70 @@ def parse_status_response(data: Any) -> str:
     return "\n".join(lines)
 
 
-def fetch_card_status(card_number: str) -> str:
-    card_type_id = os.getenv("STRELKA_CARD_TYPE_ID", DEFAULT_CARD_TYPE_ID)
-    params = {"cardnum": card_number, "cardtypeid": card_type_id}
-    response = requests.get(STRELKA_STATUS_URL, params=params, timeout=20)
+async def _request_card_status(card_number: str) -> str:
+    response = await http_client.get("", params={"cardnum": card_number})
     response.raise_for_status()
 
-    data = response.json()
+    data = orjson.loads(response.content)
 
     if isinstance(data, dict):
         error = data.get("error") or data.get("message")
         if error:
-            return f"Ошибка API: {error}"
+            raise StrelkaApiError(error)
 
     return parse_status_response(data)
 
 
+def _on_status_refreshed(card_number: str, task: asyncio.Task[str]) -> None:
+    _status_inflight.pop(card_number, None)
+    if task.cancelled():
+        return
+    exc = task.exception()
+    if exc is not None:
+        logger.warning("Card status refresh failed: %s", exc)
+        return
+    _store_card_status(card_number, task.result())
+
+
+def _store_card_status(card_number: str, status_text: str) -> None:
+    now = time.monotonic()
+    # Re-insert so the dict stays ordered by fetch time, oldest first.
+    _status_cache.pop(card_number, None)
+    _status_cache[card_number] = (now, status_text)
+    while _status_cache:
+        oldest = next(iter(_status_cache))
+        fetched_at, _ = _status_cache[oldest]
+        if (
+            len(_status_cache) <= STATUS_CACHE_SIZE
+            and now - fetched_at < STATUS_CACHE_STALE_WHILE_REVALIDATE
+        ):
+            break
+        del _status_cache[oldest]
+
+
+def _refresh_card_status(card_number: str) -> asyncio.Task[str]:
+    task = _status_inflight.get(card_number)
+    if task is None:
+        task = asyncio.create_task(_request_card_status(card_number))
+        task.add_done_callback(partial(_on_status_refreshed, card_number))
+        _status_inflight[card_number] = task
+    return task
+
+
+async def fetch_card_status(card_number: str) -> str:
+    cached = _status_cache.get(card_number)
+    if cached is not None:
+        fetched_at, status_text = cached
+        age = time.monotonic() - fetched_at
+        if age < STATUS_CACHE_MAX_AGE:
+            return status_text
+        if age < STATUS_CACHE_STALE_WHILE_REVALIDATE:
+            _refresh_card_status(card_number)
+            return status_text
+    # Shield the shared task so one cancelled caller does not abort it for others.
+    return await asyncio.shield(_refresh_card_status(card_number))
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.message is None:
         return
@@ -150,7 +452,7 @@ async def set_card(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
 
     card_number = "".join(context.args).strip()
-    if not card_number.isdigit():
+    if CARD_NUMBER_RE.fullmatch(card_number) is None:
         await update.message.reply_text("Номер карты должен содержать только цифры.")
         return
 
@@ -162,7 +464,7 @@ async def set_card(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if storage is None:
         await update.message.reply_text("Хранилище не инициализировано.")
         return
-    storage.set_user_card(user.id, card_number)
+    await storage.set_user_card(user.id, card_number)
     await update.message.reply_text(f"Карта сохранена: {card_number}")
 
 
@@ -178,7 +480,7 @@ async def show_card(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if storage is None:
         await update.message.reply_text("Хранилище не инициализировано.")
         return
-    card_number = storage.get_user_card(user.id)
+    card_number = await storage.get_user_card(user.id)
     if not card_number:
         await update.message.reply_text("Карта не сохранена. Сначала выполните /setcard <номер_карты>")
         return
@@ -198,19 +500,22 @@ async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if storage is None:
         await update.message.reply_text("Хранилище не инициализировано.")
         return
-    card_number = storage.get_user_card(user.id)
+    card_number = await storage.get_user_card(user.id)
     if not card_number:
         await update.message.reply_text("Карта не сохранена. Сначала выполните /setcard <номер_карты>")
         return
 
     await update.message.reply_text("Запрашиваю данные по карте...")
     try:
-        status_text = fetch_card_status(card_number)
-    except requests.HTTPError as exc:
+        status_text = await fetch_card_status(card_number)
+    except StrelkaApiError as exc:
+        await update.message.reply_text(f"Ошибка API: {exc}")
+        return
+    except httpx.HTTPStatusError as exc:
         logger.exception("HTTP error while requesting strelka API")
         await update.message.reply_text(f"Ошибка HTTP: {exc}")
         return
-    except requests.RequestException as exc:
+    except httpx.RequestError as exc:
         logger.exception("Request error while requesting strelka API")
         await update.message.reply_text(f"Ошибка запроса: {exc}")
         return
@@ -224,12 +529,18 @@ async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 def run_web_service() -> None:
     web_host = os.getenv("WEB_HOST", "0.0.0.0")
     web_port = int(os.getenv("WEB_PORT", "8080"))
-    uvicorn.run(app_web, host=web_host, port=web_port, log_level="info")
+    uvicorn.run(
+        app_web,
+        host=web_host,
+        port=web_port,
+        loop="uvloop" if uvloop is not None else "asyncio",
+        http="httptools",
+        log_level="info",
+    )
 
 
 def main() -> None:
-    global storage
-    load_dotenv(BASE_DIR / ".env")
+    global storage, application, webhook_url, webhook_secret
     db_path = Path(os.getenv("SQLITE_PATH", str(BASE_DIR / "data" / "bot.db")))
     storage = Storage(db_path)
 
@@ -237,16 +548,26 @@ def main() -> None:
     if not token:
         raise RuntimeError("Установите TELEGRAM_BOT_TOKEN в .env или переменных окружения")
 
-    web_thread = threading.Thread(target=run_web_service, daemon=True)
-    web_thread.start()
-
-    app = Application.builder().token(token).build()
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("setcard", set_card))
-    app.add_handler(CommandHandler("card", show_card))
-    app.add_handler(CommandHandler("balance", balance))
+    base_url = os.getenv("TELEGRAM_WEBHOOK_URL")
+    if not base_url:
+        raise RuntimeError("Установите TELEGRAM_WEBHOOK_URL в .env или переменных окружения")
+    webhook_url = base_url.rstrip("/") + WEBHOOK_PATH
+    # The webhook is registered on every start, so a fresh secret works just as well.
+    webhook_secret = os.getenv("TELEGRAM_WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+
+    application = (
+        Application.builder()
+        .token(token)
+        .request(HTTPXRequest(connection_pool_size=256, http_version="2"))
+        .updater(None)
+        .build()
+    )
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("setcard", set_card))
+    application.add_handler(CommandHandler("card", show_card))
+    application.add_handler(CommandHandler("balance", balance))
 
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    run_web_service()
 
 
 if __name__ == "__main__":